@@ -1,84 +1,359 @@
 #!/usr/bin/env python3
+import argparse
+import hashlib
 import json
 import os
-from datetime import datetime, timezone
-from urllib.request import urlopen, Request
+import sys
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Union
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+try:
+    import orjson
+except ImportError:  # optional speedup; the stdlib json fallback keeps this zero-dep
+    orjson = None
 
 DATA_DIR = "data"
 OUT_PATH = os.path.join(DATA_DIR, "market.json")
 MANUAL_PATH = os.path.join(DATA_DIR, "manual.json")
+# ETag/Last-Modified validators plus the parsed body they vouch for (FX URL only).
+HTTP_CACHE_PATH = os.path.join(DATA_DIR, "http_cache.json")
 
 # Free, no-key FX source (ECB-based). Docs: frankfurter.dev
-FX_URL = "https://api.frankfurter.dev/v1/latest?base=USD&symbols=TRY"
+# All USD-based pairs come back from a single comma-separated symbols query.
+FX_PAIRS = {"usdtry": "TRY"}
+FX_URL = "https://api.frankfurter.dev/v1/latest?base=USD&symbols=" + ",".join(FX_PAIRS.values())
 
+USER_AGENT = "ykcapitalholdings-market-pulse/1.0"
 
-def utc_now_iso():
-    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+# Transient failures worth another attempt.
+HTTP_RETRIES = 2
+HTTP_BACKOFF = 0.3
+RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
 
+# Bodies are read incrementally and refused past this size.
+READ_CHUNK = 16384
+MAX_BODY_BYTES = 2 * 1024 * 1024
 
-def fetch_json(url: str) -> dict:
-    req = Request(url, headers={"User-Agent": "ykcapitalholdings-market-pulse"})
-    with urlopen(req, timeout=20) as r:
-        return json.loads(r.read().decode("utf-8"))
 
+def json_loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
 
-def safe_load_manual() -> dict:
-    if not os.path.exists(MANUAL_PATH):
-        return {}
+
+def json_dumps(obj, indent: bool = False, sort_keys: bool = False) -> bytes:
+    if orjson is not None:
+        option = 0
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option)
+    text = json.dumps(
+        obj,
+        ensure_ascii=False,
+        indent=2 if indent else None,
+        separators=None if indent else (",", ":"),
+        sort_keys=sort_keys,
+    )
+    return text.encode("utf-8")
+
+
+@dataclass(slots=True)
+class SeriesEntry:
+    """One card on the Market Pulse page; serialized as-is into market.json."""
+
+    value: Optional[Union[float, str]] = None  # str: unparseable manual.json text, kept as typed
+    unit: str = ""
+    source: str = ""
+    as_of: Optional[str] = None
+
+    @classmethod
+    def from_dict(cls, obj: dict) -> "SeriesEntry":
+        return cls(
+            value=obj.get("value"),
+            unit=obj.get("unit", ""),
+            source=obj.get("source", ""),
+            as_of=obj.get("as_of"),
+        )
+
+
+def _read_body(resp) -> bytes:
+    buf = bytearray()
+    while True:
+        chunk = resp.read(READ_CHUNK)
+        if not chunk:
+            return bytes(buf)
+        buf += chunk
+        if len(buf) > MAX_BODY_BYTES:
+            raise ValueError(f"response body exceeds {MAX_BODY_BYTES} bytes")
+
+
+def http_request(url: str, timeout: float = 20, headers: Optional[dict] = None):
+    """GET url, retrying transient failures. Returns (status, headers, body); 304 is not an error."""
+    req_headers = {"User-Agent": USER_AGENT}
+    req_headers.update(headers or {})
+
+    for attempt in range(HTTP_RETRIES + 1):
+        if attempt:
+            time.sleep(HTTP_BACKOFF * (2 ** (attempt - 1)))
+        try:
+            with urlopen(Request(url, headers=req_headers), timeout=timeout) as r:
+                return r.status, r.headers, _read_body(r)
+        except HTTPError as e:
+            if e.code == 304:
+                return e.code, e.headers, b""
+            if e.code not in RETRY_STATUSES or attempt == HTTP_RETRIES:
+                raise
+        except OSError:  # URLError, timeouts, dropped connections
+            if attempt == HTTP_RETRIES:
+                raise
+
+
+def fetch_json_conditional(url: str) -> dict:
+    """GET url as JSON, revalidating against HTTP_CACHE_PATH and reusing it on 304."""
+    entry = load_json(HTTP_CACHE_PATH, {})
+    if entry.get("url") != url:
+        entry = {}
+    headers = {}
+    if "data" in entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    status, resp_headers, body = http_request(url, headers=headers)
+    if status == 304 and "data" in entry:
+        return entry["data"]
+
+    # The cache holds only the current URL, so a stale entry (e.g. after
+    # FX_PAIRS changes) is replaced rather than kept in the published file.
+    data = json_loads(body)
+    etag = resp_headers.get("ETag")
+    last_modified = resp_headers.get("Last-Modified")
+    if etag or last_modified:
+        entry = {"url": url, "etag": etag, "last_modified": last_modified, "data": data}
+        save_json(HTTP_CACHE_PATH, entry)
+    elif os.path.exists(HTTP_CACHE_PATH):
+        os.remove(HTTP_CACHE_PATH)
+    return data
+
+
+def fetch_fx() -> dict:
+    fx = fetch_json_conditional(FX_URL)
+    rates = fx.get("rates", {})
+    date = fx.get("date")  # e.g. "2024-11-25" (latest working day)
+    out = {}
+    for key, symbol in FX_PAIRS.items():
+        rate = rates.get(symbol)
+        if rate is not None:
+            out[key] = {"value": float(rate), "as_of": date}
+    return out
+
+
+# Manually maintained series: key -> default unit (order is output order).
+MANUAL_SERIES = {
+    "wci": "USD/40ft",
+    "bdi": "Index",
+    "fbx": "Index",
+}
+
+# Every series key in market.json, in output order.
+SERIES_KEYS = (*FX_PAIRS, *MANUAL_SERIES)
+
+
+def _parse_money(s: str) -> Optional[float]:
+    """Parse "$2,127" / "2,127.50" in one pass without copying s.
+
+    The whole string (surrounding whitespace aside) must match
+    ``[$]?[0-9,]+(\.[0-9]+)?`` with ASCII digits; anything else returns None.
+    """
+    i, n = 0, len(s)
+    while i < n and s[i].isspace():
+        i += 1
+    while n > i and s[n - 1].isspace():
+        n -= 1
+    if i < n and s[i] == "$":
+        i += 1
+
+    v = 0
+    int_digits = 0
+    frac_digits = None  # None until the decimal point is seen
+    for k in range(i, n):
+        c = s[k]
+        if "0" <= c <= "9":
+            v = v * 10 + (ord(c) - 48)
+            if frac_digits is None:
+                int_digits += 1
+            else:
+                frac_digits += 1
+        elif c == "," and frac_digits is None:
+            continue
+        elif c == "." and frac_digits is None:
+            frac_digits = 0
+        else:
+            return None
+    if not int_digits or frac_digits == 0:
+        return None
+    return v / 10 ** (frac_digits or 0)
+
+
+def manual_entries(manual: dict) -> dict:
+    if not isinstance(manual, dict):
+        manual = {}
+    manual_series = manual.get("series") or {}
+    default_as_of = manual.get("as_of") or None
+
+    out = {}
+    for key, default_unit in MANUAL_SERIES.items():
+        obj = manual_series.get(key) or {}
+        value = obj.get("value")
+        if isinstance(value, str):
+            # Hand-edited values are sometimes pasted as "$2,127". Anything
+            # else is published as typed, as before, but flagged in the log.
+            parsed = _parse_money(value)
+            if parsed is None:
+                print(
+                    f"warning: manual.json series {key!r}: value {value!r} is not a number",
+                    file=sys.stderr,
+                )
+            else:
+                value = parsed
+        out[key] = SeriesEntry(
+            value=value,
+            unit=obj.get("unit", default_unit),
+            source=obj.get("source", "manual"),
+            as_of=obj.get("as_of") or default_as_of,
+        )
+    return out
+
+
+def load_json(path: str, default: dict) -> dict:
+    if not os.path.exists(path):
+        return default
     try:
-        with open(MANUAL_PATH, "r", encoding="utf-8") as f:
-            return json.load(f) or {}
+        with open(path, "rb") as f:
+            return json_loads(f.read()) or default
     except Exception:
-        return {}
+        return default
+
+
+def payload_digest(doc: dict) -> str:
+    """Digest of a market.json document, ignoring its generated_at stamp."""
+    body = {k: v for k, v in doc.items() if k != "generated_at"}
+    payload = json_dumps(body, sort_keys=True)
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def save_json(path: str, obj: dict) -> None:
+    # Write a sibling temp file and swap it in, so readers and a crashed run
+    # never see a half-written document.
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(json_dumps(obj, indent=True))
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def safe_load_manual() -> dict:
+    return load_json(MANUAL_PATH, {})
 
 
-def main():
+def latest_fx_day(now: datetime) -> str:
+    # ECB reference rates are published on weekdays only.
+    day = now.date()
+    while day.weekday() >= 5:
+        day -= timedelta(days=1)
+    return day.isoformat()
+
+
+def cached_fx(existing: dict, now: datetime) -> Optional[dict]:
+    """FX values from the previous market.json, if no newer fixing can exist yet."""
+    series = (existing.get("series") or {}) if isinstance(existing, dict) else {}
+    latest = latest_fx_day(now)
+    out = {}
+    for key in FX_PAIRS:
+        entry = series.get(key) or {}
+        if entry.get("value") is None or entry.get("as_of") != latest:
+            return None
+        out[key] = {"value": entry["value"], "as_of": entry["as_of"]}
+    return out
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Regenerate data/market.json.")
+    p.add_argument(
+        "--refresh",
+        action="store_true",
+        help="fetch FX rates even if market.json already has today's fixing",
+    )
+    p.add_argument(
+        "--only",
+        action="append",
+        choices=SERIES_KEYS,
+        metavar="KEY",
+        help="refresh only this series (repeatable); others keep their previous values",
+    )
+    return p.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     os.makedirs(DATA_DIR, exist_ok=True)
 
+    # One clock reading per run: the FX cache check and the header agree.
+    run_at = datetime.now(timezone.utc).replace(microsecond=0)
+    run_ts = run_at.isoformat()
+
+    selected = set(args.only or SERIES_KEYS)
+    existing = load_json(OUT_PATH, {})
+    previous = (existing.get("series") or {}) if isinstance(existing, dict) else {}
+
+    # Skip the FX round trip when the last run already stored today's fixing.
+    fx_cached = None if args.refresh else cached_fx(existing, run_at)
+    need_fx = fx_cached is None and bool(selected.intersection(FX_PAIRS))
+
     # 1) Auto: USD/TRY
-    usdtry = {
-        "value": None,
-        "unit": "TRY per USD",
-        "source": "auto (frankfurter.dev)",
-        "as_of": None,
-    }
+    usdtry = SeriesEntry(unit="TRY per USD", source="auto (frankfurter.dev)")
 
     try:
-        fx = fetch_json(FX_URL)
-        rate = fx.get("rates", {}).get("TRY")
-        date = fx.get("date")  # e.g. "2024-11-25" (latest working day)
-        if rate is not None:
-            usdtry["value"] = float(rate)
-            usdtry["as_of"] = date
+        fx = fetch_fx() if need_fx else (fx_cached or {})
+        rate = fx.get("usdtry") or {}
+        usdtry.value = rate.get("value")
+        usdtry.as_of = rate.get("as_of")
     except Exception as e:
         # keep None values if fetch fails
-        usdtry["source"] = f"auto failed: {type(e).__name__}"
+        usdtry.source = f"auto failed: {type(e).__name__}"
 
     # 2) Manual series (WCI/BDI/FBX)
     manual = safe_load_manual()
-    manual_series = (manual.get("series") or {}) if isinstance(manual, dict) else {}
+    series = {"usdtry": usdtry, **manual_entries(manual)}
 
-    def manual_entry(key, default_unit):
-        obj = manual_series.get(key) or {}
-        return {
-            "value": obj.get("value"),
-            "unit": obj.get("unit", default_unit),
-            "source": obj.get("source", "manual"),
-            "as_of": obj.get("as_of") or manual.get("as_of") or None,
-        }
+    for key in series:
+        if key not in selected and key in previous:
+            series[key] = SeriesEntry.from_dict(previous[key])
 
     out = {
-        "generated_at": utc_now_iso(),
-        "series": {
-            "usdtry": usdtry,
-            "wci": manual_entry("wci", "USD/40ft"),
-            "bdi": manual_entry("bdi", "Index"),
-            "fbx": manual_entry("fbx", "Index"),
-        },
+        "generated_at": run_ts,
+        "series": {key: asdict(entry) for key, entry in series.items()},
     }
 
-    with open(OUT_PATH, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False, indent=2)
+    # Leave the file (and its timestamp) alone so idle runs produce no commit.
+    if isinstance(existing, dict) and payload_digest(existing) == payload_digest(out):
+        print(f"No change to {OUT_PATH}")
+        return
+
+    save_json(OUT_PATH, out)
 
     print(f"Wrote {OUT_PATH}")
 